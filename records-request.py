@@ -1,31 +1,87 @@
+import re
+import threading
 from base64 import b64decode
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 
 import yaml
 from loguru import logger
-from nameparser import HumanName
 from selenium import webdriver
-from selenium.common.exceptions import NoSuchElementException, TimeoutException
+from selenium.common.exceptions import (
+    ElementNotInteractableException,
+    NoSuchElementException,
+    StaleElementReferenceException,
+    TimeoutException,
+)
 from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.chrome.webdriver import WebDriver
 from selenium.webdriver.common.by import By
-from selenium.webdriver.common.print_page_options import PrintOptions
+from selenium.webdriver.remote.webelement import WebElement
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
 
+# Prefer the libyaml-backed loader when PyYAML was built with it
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
 CONFIG_FILE = "info.yml"
 SOURCE_FILE = "records.txt"
 SUCCESS_FILE = "savedrecords.txt"
 FAILURE_FILE = "recordfailures.txt"
 OUTPUT_DIR = Path("School Records Requests")
+PROFILE_DIR = Path.home() / ".ta-bot-profile"
+ANALYTICS_URLS = [
+    "*://*.google-analytics.com/*",
+    "*://*.googletagmanager.com/*",
+    "*://*.doubleclick.net/*",
+]
+# Images and fonts are only blocked while navigating, never on printed forms
+NAVIGATION_BLOCKED_URLS = [
+    "*.png",
+    "*.jpg",
+    "*.jpeg",
+    "*.gif",
+    "*.woff",
+    "*.woff2",
+    "*.ttf",
+    *ANALYTICS_URLS,
+]
 WAIT_TIMEOUT = 15  # seconds
+WORKER_COUNT = 4  # parallel browser sessions
+CSV_BUFFER_SIZE = 64 * 1024  # bytes
+PDF_BUFFER_SIZE = 1024 * 1024  # bytes
+PDF_CHUNK_SIZE = 256 * 1024  # bytes per DevTools IO.read
+PDF_MARGIN_INCHES = 1 / 2.54  # 1 cm
+
+# Locators shared across pages and clients
+CLIENTS_NAV_LOCATOR = (By.XPATH, "//*[contains(text(), 'Clients')]")
+DOCS_NAV_LOCATOR = (By.LINK_TEXT, "Docs & Forms")
+USERNAME_INPUT_LOCATOR = (By.NAME, "user_username")
+PASSWORD_INPUT_LOCATOR = (By.NAME, "user_password")
+SEARCH_BUTTON_LOCATOR = (By.CSS_SELECTOR, "button[aria-label='Search']")
+CLIENT_RESULT_LOCATOR = (
+    By.CSS_SELECTOR,
+    "a[aria-description*='Press Enter to view the profile of']",
+)
+CLIENT_NAME_LOCATOR = (By.CLASS_NAME, "text-h4")
+CONSENT_TEXT_LOCATOR = (By.XPATH, "//*[contains(text(), 'I authorize')]")
+
+CLIENT_NAME_RE = re.compile(r"^\s*(\S+)\s+(\S+)\s*$")
+# Anything other than letters, digits, spaces, "." and "_"
+UNSAFE_FILENAME_CHARS_RE = re.compile(r"[^\w .]")
+NAME_TITLES = {"dr", "mr", "mrs", "ms", "miss"}
+NAME_SUFFIXES = {"jr", "sr", "ii", "iii", "iv"}
 
 
 def load_config(file_path: str) -> dict:
     """Loads configuration from a YAML file."""
     try:
         with open(file_path, "r") as file:
-            return yaml.safe_load(file)["services"]
+            return yaml.load(file, Loader=YamlLoader)["services"]
     except FileNotFoundError:
         logger.error(f"Config file not found: {file_path}")
         return {}
@@ -34,6 +90,56 @@ def load_config(file_path: str) -> dict:
         return {}
 
 
+def _name_token(word: str) -> str:
+    """Normalizes a name word for comparison against titles and suffixes."""
+    return word.lower().rstrip(".")
+
+
+def split_display_name(full_name: str) -> tuple[str, str]:
+    """Returns the first and last name from a display name.
+
+    Handles "Last, First" headings, and skips leading titles and trailing
+    suffixes as long as a first and last name remain. A single name is
+    returned as the first name with an empty last name.
+
+    >>> split_display_name("Dr. John Smith III")
+    ('John', 'Smith')
+    >>> split_display_name("Ivan Iv")
+    ('Ivan', 'Iv')
+    >>> split_display_name("Smith, John")
+    ('John', 'Smith')
+    >>> split_display_name("Smith, Jr., John")
+    ('John', 'Smith')
+    >>> split_display_name("John Smith, Jr.")
+    ('John', 'Smith')
+    >>> split_display_name("Smith,")
+    ('Smith', '')
+    """
+    head, comma, tail = full_name.partition(",")
+    tail_words = tail.replace(",", " ").split()
+    if comma and not all(_name_token(w) in NAME_SUFFIXES for w in tail_words):
+        # "Last, First [Middle]", possibly with a suffix on either side
+        while _name_token(tail_words[0]) in NAME_SUFFIXES:
+            tail_words.pop(0)
+        while _name_token(tail_words[-1]) in NAME_SUFFIXES:
+            tail_words.pop()
+        words = tail_words + head.split()
+    else:
+        # "First [Middle] Last", possibly followed by ", Suffix"
+        words = head.split() + tail_words
+
+    while len(words) > 2 and _name_token(words[0]) in NAME_TITLES:
+        words.pop(0)
+    while len(words) > 2 and _name_token(words[-1]) in NAME_SUFFIXES:
+        words.pop()
+
+    if not words:
+        raise ValueError(f"Could not parse client name: '{full_name}'")
+    if len(words) == 1:
+        return words[0], ""
+    return words[0], words[-1]
+
+
 def load_previous_csv(filepath: Path) -> set:
     """Reads a comma-separated file and returns a set of its items."""
     if not filepath.exists():
@@ -46,29 +152,49 @@ def load_previous_csv(filepath: Path) -> set:
         return {item.strip() for item in content.split(",") if item.strip()}
 
 
-def append_to_csv_file(filepath: Path, data: str):
-    """Appends data to a comma-separated file, handling separators correctly."""
-    prefix = ""
-    # Add a separator only if the file already exists and is not empty
-    if filepath.exists() and filepath.stat().st_size > 0:
-        prefix = ", "
+def append_to_csv_file(filepath: Path, items: list[str]):
+    """Appends items to a comma-separated file in a single write."""
+    if not items:
+        return
+
+    with open(filepath, "a", buffering=CSV_BUFFER_SIZE) as f:
+        # Append mode starts at the end, so a non-zero offset means existing data
+        prefix = ", " if f.tell() > 0 else ""
+        f.write(prefix + ", ".join(items))
+
 
-    with open(filepath, "a") as f:
-        f.write(f"{prefix}{data}")
+def block_urls(driver: WebDriver, urls: list[str]):
+    """Blocks matching requests in the driver's current tab via DevTools."""
+    driver.execute_cdp_cmd("Network.enable", {})
+    driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": urls})
 
 
 class TherapyAppointmentBot:
     """A bot to automate downloading client documents from TherapyAppointment."""
 
-    def __init__(self, config: dict):
+    def __init__(self, config: dict, profile_dir: Path):
         self.config = config["therapyappointment"]
-        self.driver = self._initialize_driver()
+        self.driver = self._initialize_driver(profile_dir)
         self.wait = WebDriverWait(self.driver, WAIT_TIMEOUT)
+        self._clients_nav: WebElement | None = None
 
-    def _initialize_driver(self) -> WebDriver:
-        """Initializes the Chrome WebDriver."""
+    def _initialize_driver(self, profile_dir: Path) -> WebDriver:
+        """Initializes the Chrome WebDriver with a persistent profile."""
         chrome_options = Options()
-        driver = webdriver.Chrome(options=chrome_options)
+        # Keep the session cookie between runs so login can be skipped
+        chrome_options.add_argument(f"--user-data-dir={profile_dir}")
+        chrome_options.add_argument("--headless=new")
+        chrome_options.add_argument("--window-size=1920,1080")
+        chrome_options.add_argument("--disable-gpu")
+        chrome_options.add_argument("--disable-dev-shm-usage")
+        chrome_options.add_argument("--disable-extensions")
+        # Own process group, so a terminal Ctrl-C doesn't kill the browsers
+        # mid-client; main() stops the workers between clients instead
+        service = Service(popen_kw={"start_new_session": True})
+        driver = webdriver.Chrome(options=chrome_options, service=service)
+
+        # Blocking only applies to the current tab, i.e. the navigation tab
+        block_urls(driver, NAVIGATION_BLOCKED_URLS)
         return driver
 
     def __enter__(self):
@@ -85,56 +211,99 @@ class TherapyAppointmentBot:
         """Logs into the TherapyAppointment portal."""
         logger.info("Logging into TherapyAppointment...")
         self.driver.get("https://portal.therapyappointment.com")
-        self.driver.maximize_window()
 
-        username_field = self.wait.until(
-            EC.presence_of_element_located((By.NAME, "user_username"))
+        # A saved session lands on the portal, otherwise we get the login form.
+        # The username field is checked first since "Clients" could also
+        # appear as text on the login page.
+        landing_element = self.wait.until(
+            EC.any_of(
+                EC.presence_of_element_located(USERNAME_INPUT_LOCATOR),
+                EC.element_to_be_clickable(CLIENTS_NAV_LOCATOR),
+            )
         )
+        username_fields = self.driver.find_elements(*USERNAME_INPUT_LOCATOR)
+        if not username_fields:
+            self._clients_nav = landing_element
+            logger.success("Already logged in from a saved session.")
+            return
+
+        username_field = username_fields[0]
         username_field.send_keys(self.config["username"])
 
-        password_field = self.driver.find_element(By.NAME, "user_password")
+        password_field = self.driver.find_element(*PASSWORD_INPUT_LOCATOR)
         password_field.send_keys(self.config["password"])
         password_field.submit()
+
+        # Wait for the main navigation so callers start from a loaded portal
+        self._clients_nav = self.wait.until(
+            EC.element_to_be_clickable(CLIENTS_NAV_LOCATOR)
+        )
         logger.success("Login successful.")
 
+    def _click_clients_nav(self):
+        """Clicks the cached Clients navigation, re-locating it once if needed."""
+        if self._clients_nav is not None:
+            try:
+                self._clients_nav.click()
+                return
+            except (StaleElementReferenceException, ElementNotInteractableException):
+                logger.debug("Cached Clients navigation is unusable, re-locating.")
+
+        self._clients_nav = self.wait.until(
+            EC.element_to_be_clickable(CLIENTS_NAV_LOCATOR)
+        )
+        self._clients_nav.click()
+
     def go_to_client(self, first_name: str, last_name: str) -> bool:
         """Navigates to a specific client in TherapyAppointment."""
         logger.info(f"Searching for client: {first_name} {last_name}...")
         try:
-            # Wait for the main navigation to be clickable
-            clients_button = self.wait.until(
-                EC.element_to_be_clickable(
-                    (By.XPATH, "//*[contains(text(), 'Clients')]")
-                )
-            )
-            clients_button.click()
-
-            # Wait for the search form to be ready
-            firstname_field = self.wait.until(
-                EC.visibility_of_element_located(
-                    (By.XPATH, "//label[text()='First Name']/following-sibling::input")
+            self._click_clients_nav()
+
+            # Fill in and submit the search form in a single round trip,
+            # retrying until the inputs and the Search button have all rendered
+            fill_search_form = """
+                const [firstName, lastName, searchSelector] = arguments;
+                const labels = [...document.querySelectorAll("label")];
+                // Match the label's own text, ignoring whitespace and markers
+                const labelText = (label) => {
+                    const text = [...label.childNodes].find(
+                        (node) => node.nodeType === Node.TEXT_NODE && node.data.trim()
+                    );
+                    return text ? text.data.trim() : label.textContent.trim();
+                };
+                const findInput = (text) => {
+                    const label = labels.find((l) => labelText(l) === text);
+                    let sibling = label ? label.nextElementSibling : null;
+                    while (sibling && sibling.tagName !== "INPUT") {
+                        sibling = sibling.nextElementSibling;
+                    }
+                    return sibling;
+                };
+                const fields = [
+                    [findInput("First Name"), firstName],
+                    [findInput("Last Name"), lastName],
+                ];
+                const searchButton = document.querySelector(searchSelector);
+                if (!searchButton || fields.some(([input]) => !input)) {
+                    return false;
+                }
+                for (const [input, value] of fields) {
+                    input.value = value;
+                    input.dispatchEvent(new Event("input", { bubbles: true }));
+                }
+                searchButton.click();
+                return true;
+                """
+            self.wait.until(
+                lambda driver: driver.execute_script(
+                    fill_search_form, first_name, last_name, SEARCH_BUTTON_LOCATOR[1]
                 )
             )
-            firstname_field.send_keys(first_name)
-
-            lastname_field = self.driver.find_element(
-                By.XPATH, "//label[text()='Last Name']/following-sibling::input"
-            )
-            lastname_field.send_keys(last_name)
-
-            search_button = self.driver.find_element(
-                By.CSS_SELECTOR, "button[aria-label='Search']"
-            )
-            search_button.click()
 
             # Wait for the search result link and click it
             client_link = self.wait.until(
-                EC.element_to_be_clickable(
-                    (
-                        By.CSS_SELECTOR,
-                        "a[aria-description*='Press Enter to view the profile of']",
-                    )
-                )
+                EC.element_to_be_clickable(CLIENT_RESULT_LOCATOR)
             )
             client_link.click()
             return True
@@ -154,21 +323,35 @@ class TherapyAppointmentBot:
         logger.info("Extracting client data...")
         # Wait for the name to ensure the page is loaded
         name_element = self.wait.until(
-            EC.visibility_of_element_located((By.CLASS_NAME, "text-h4"))
+            EC.visibility_of_element_located(CLIENT_NAME_LOCATOR)
         )
-        name = HumanName(name_element.text)
 
-        birthdate = (
-            self.driver.find_element(
-                By.XPATH, "//div[contains(normalize-space(text()), 'DOB ')]"
-            )
-            .text.split()[-1]
-            .replace("/", "")
+        # Read everything we need from the profile in a single round trip
+        profile = self.driver.execute_script(
+            """
+            const heading = arguments[0];
+            // Only look at each div's own leading text, not its descendants
+            const dob = [...document.querySelectorAll("div")].find((div) => {
+                const text = [...div.childNodes].find(
+                    (node) => node.nodeType === Node.TEXT_NODE
+                );
+                return text && /DOB\\s/.test(text.data);
+            });
+            return {
+                name: heading.innerText,
+                dob: dob ? dob.innerText : null,
+            };
+            """,
+            name_element,
         )
+        if not profile["dob"]:
+            raise NoSuchElementException("Could not find client DOB on profile page")
+
+        first_name, last_name = split_display_name(profile["name"])
+        birthdate = profile["dob"].split()[-1].replace("/", "")
 
-        keepcharacters = (" ", ".", "_")
-        safe_fullname = "".join(
-            c for c in f"{name.first} {name.last}" if c.isalnum() or c in keepcharacters
+        safe_fullname = UNSAFE_FILENAME_CHARS_RE.sub(
+            "", f"{first_name} {last_name}"
         ).rstrip()
 
         data = {
@@ -183,6 +366,9 @@ class TherapyAppointmentBot:
         logger.info("Navigating to Docs & Forms...")
         OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
+        docs_button = self.wait.until(EC.element_to_be_clickable(DOCS_NAV_LOCATOR))
+        docs_button.click()
+
         self._save_document_as_pdf(
             "Receiving Consent to Release of Information", client_data
         )
@@ -190,30 +376,60 @@ class TherapyAppointmentBot:
             "Sending Consent to Release of Information", client_data
         )
 
-        clients_button = self.driver.find_element(
-            By.XPATH, "//*[contains(text(), 'Clients')]"
+    def _print_page_to_file(self, filename: Path):
+        """Prints the current page to a PDF file, streaming it via DevTools."""
+        # Portrait US Letter with 1 cm margins, matching driver.print_page()
+        result = self.driver.execute_cdp_cmd(
+            "Page.printToPDF",
+            {
+                "landscape": False,
+                "paperWidth": 8.5,
+                "paperHeight": 11,
+                "marginTop": PDF_MARGIN_INCHES,
+                "marginBottom": PDF_MARGIN_INCHES,
+                "marginLeft": PDF_MARGIN_INCHES,
+                "marginRight": PDF_MARGIN_INCHES,
+                "transferMode": "ReturnAsStream",
+            },
         )
-        clients_button.click()
+        stream = result["stream"]
+        # Stream into a sibling file so a failed read never leaves a partial PDF
+        partial_file = filename.with_name(f"{filename.name}.part")
+        try:
+            with open(partial_file, "wb", buffering=PDF_BUFFER_SIZE) as file:
+                while True:
+                    chunk = self.driver.execute_cdp_cmd(
+                        "IO.read", {"handle": stream, "size": PDF_CHUNK_SIZE}
+                    )
+                    data = chunk["data"]
+                    if chunk.get("base64Encoded"):
+                        file.write(b64decode(data))
+                    else:
+                        file.write(data.encode())
+                    if chunk.get("eof"):
+                        break
+            partial_file.replace(filename)
+        finally:
+            partial_file.unlink(missing_ok=True)
+            self.driver.execute_cdp_cmd("IO.close", {"handle": stream})
 
     def _save_document_as_pdf(self, link_text: str, client: dict):
-        """Helper function to find, print, and save a single document."""
+        """Helper function to open, print, and save a single document in a new tab."""
         logger.info(f"Opening {link_text}...")
+        docs_window = self.driver.current_window_handle
         try:
-            docs_button = self.wait.until(
-                EC.element_to_be_clickable((By.LINK_TEXT, "Docs & Forms"))
-            )
-            docs_button.click()
-
             document_link = self.wait.until(
                 EC.element_to_be_clickable((By.LINK_TEXT, link_text))
             )
-            document_link.click()
+            document_url = document_link.get_attribute("href")
+            # Open in a new tab so the Docs & Forms list stays loaded;
+            # new_window() switches to the tab it creates
+            self.driver.switch_to.new_window("tab")
+            # The new tab has its own DevTools session, so block before loading
+            block_urls(self.driver, ANALYTICS_URLS)
+            self.driver.get(document_url)
 
-            self.wait.until(
-                EC.visibility_of_element_located(
-                    (By.XPATH, "//*[contains(text(), 'I authorize')]")
-                )
-            )
+            self.wait.until(EC.visibility_of_element_located(CONSENT_TEXT_LOCATOR))
 
             doc_type = link_text.split(" ")[0]
 
@@ -223,12 +439,7 @@ class TherapyAppointmentBot:
             )
 
             logger.info(f"Saving {filename}...")
-            pdf_options = PrintOptions()
-            pdf_options.orientation = "portrait"
-
-            pdf_base64 = self.driver.print_page(pdf_options)
-            with open(filename, "wb") as file:
-                file.write(b64decode(pdf_base64))
+            self._print_page_to_file(filename)
 
             if filename.exists():
                 logger.success(f"Saved {filename}")
@@ -236,8 +447,51 @@ class TherapyAppointmentBot:
         except TimeoutException:
             logger.error(f"Could not find or load document: {link_text}")
         finally:
-            # Go back to the Docs & Forms list
-            self.driver.back()
+            # Close the document tab and return to the Docs & Forms list
+            if self.driver.current_window_handle != docs_window:
+                self.driver.close()
+                self.driver.switch_to.window(docs_window)
+
+
+def process_clients(
+    config: dict,
+    worker_id: int,
+    clients: list[tuple[str, str, str]],
+    successful: list[str],
+    failed: list[str],
+    stop_event: threading.Event,
+):
+    """Processes a batch of clients with a dedicated bot and browser session.
+
+    Client names are collected into the shared ``successful`` and ``failed``
+    lists; the caller is responsible for writing them out. The worker stops
+    before its next client once ``stop_event`` is set.
+    """
+    # Chrome locks its profile, so each worker needs its own directory
+    profile_dir = PROFILE_DIR / f"worker-{worker_id}"
+    with TherapyAppointmentBot(config, profile_dir) as bot:
+        bot.login()
+        for client_name, first, last in clients:
+            if stop_event.is_set():
+                logger.info(f"Worker {worker_id} stopping early.")
+                break
+
+            if bot.go_to_client(first, last):
+                try:
+                    client_data = bot.extract_client_data()
+                    bot.download_consent_forms(client_data)
+                    successful.append(client_name)
+                except Exception as e:
+                    if stop_event.is_set():
+                        # Likely caused by the interrupt; leave it for next run
+                        logger.warning(f"Interrupted while processing {client_name}")
+                        break
+                    logger.error(
+                        f"An error occurred while processing {client_name}: {e}"
+                    )
+                    failed.append(client_name)
+            elif not stop_event.is_set():
+                failed.append(client_name)
 
 
 def main():
@@ -266,35 +520,51 @@ def main():
 
     logger.info(f"Found {len(new_clients)} new clients to process.")
 
-    new_success_count = 0
-    new_failure_count = 0
-
-    with TherapyAppointmentBot(config) as bot:
-        bot.login()
-        for client_name in new_clients:
-            try:
-                first, last = client_name.split()
-            except ValueError:
-                logger.warning(f"Skipping malformed name: '{client_name}'")
-                append_to_csv_file(Path(FAILURE_FILE), client_name)
-                new_failure_count += 1
-                continue
+    successful_buffer: list[str] = []
+    failed_buffer: list[str] = []
+
+    # Parse every name up front so malformed entries never reach a browser
+    parsed_clients = []
+    for client_name in sorted(new_clients):
+        match = CLIENT_NAME_RE.match(client_name)
+        if match:
+            parsed_clients.append((client_name, match.group(1), match.group(2)))
+        else:
+            failed_buffer.append(client_name)
+    if failed_buffer:
+        logger.warning(f"Skipping malformed names: {failed_buffer}")
+
+    # Split clients round-robin so each worker gets a similar share
+    shards = [parsed_clients[i::WORKER_COUNT] for i in range(WORKER_COUNT)]
+    shards = [shard for shard in shards if shard]
+
+    stop_event = threading.Event()
+    worker = partial(
+        process_clients,
+        config,
+        successful=successful_buffer,
+        failed=failed_buffer,
+        stop_event=stop_event,
+    )
 
-            if bot.go_to_client(first, last):
+    try:
+        if shards:
+            with ThreadPoolExecutor(max_workers=len(shards)) as executor:
                 try:
-                    client_data = bot.extract_client_data()
-                    bot.download_consent_forms(client_data)
-                    append_to_csv_file(Path(SUCCESS_FILE), client_name)
-                    new_success_count += 1
-                except Exception as e:
-                    logger.error(
-                        f"An error occurred while processing {client_name}: {e}"
-                    )
-                    append_to_csv_file(Path(FAILURE_FILE), client_name)
-                    new_failure_count += 1
-            else:
-                append_to_csv_file(Path(FAILURE_FILE), client_name)
-                new_failure_count += 1
+                    list(executor.map(worker, range(len(shards)), shards))
+                except KeyboardInterrupt:
+                    # Let workers finish their current client instead of their
+                    # whole shard before the executor shuts down
+                    logger.warning("Interrupted, stopping after current clients...")
+                    stop_event.set()
+                    raise
+    finally:
+        # Record whatever was processed, even if a worker crashed
+        append_to_csv_file(Path(SUCCESS_FILE), successful_buffer)
+        append_to_csv_file(Path(FAILURE_FILE), failed_buffer)
+
+    new_success_count = len(successful_buffer)
+    new_failure_count = len(failed_buffer)
 
     with open(SOURCE_FILE, "w") as f:
         f.truncate(0)